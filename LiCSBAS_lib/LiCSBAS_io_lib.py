@@ -192,13 +192,17 @@ def read_geotiff(file, file_ref=None):
 
 
 #%%
-def read_img(file, length, width, dtype=np.float32, endian='little'):
+def read_img(file, length, width, dtype=np.float32, endian='little', memmap=False):
     """
     Read image data into numpy array.
     endian: 'little' or 'big' (not 'little' is regarded as 'big')
+    memmap: return a read-only np.memmap instead of reading the whole file
+            (little endian only), copy it before modifying in place
     """
 
-    if endian == 'little':
+    if memmap and endian == 'little':
+        data = np.memmap(file, dtype=dtype, mode='r', shape=(length, width))
+    elif endian == 'little':
         data = np.fromfile(file, dtype=dtype).reshape((length, width))
     else:
         data = np.fromfile(file, dtype=dtype).byteswap().reshape((length, width))
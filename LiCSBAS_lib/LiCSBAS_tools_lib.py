@@ -60,6 +60,145 @@ def bl2xy(lon, lat, width, length, lat1, postlat, lon1, postlon):
     return [x, y]
 
 
+#%%
+def calc_hist_peak(x, lo=-2.5, hi=2.5, w=0.1):
+    """
+    Histogram peak of x, i.e. center of the fullest of the uniform bins of
+    width w between lo and hi, counted with calc_hist_uniform ignoring nan.
+    """
+    counts, bin_edges = calc_hist_uniform(x, lo, hi, w)
+
+    return bin_edges[counts.argmax()] + w/2
+
+
+#%%
+def calc_hist_uniform(x, lo, hi, w):
+    """
+    Histogram of x in uniform bins of width w between lo and hi, counted in one
+    linear pass with np.bincount instead of np.histogram's bin search, reduced
+    over blocks of 2**20 elements of the flattened array so only block-sized
+    temporaries are made. As np.histogram, the last bin is closed, i.e.
+    x == hi is counted in it; nan and values outside [lo, hi] are not counted.
+
+    Returns:
+        counts    : Counts in each bin
+        bin_edges : Bin edges, one more than counts
+
+    Example:
+        >>> calc_hist_uniform(np.array([-1., 0.5, 1., np.nan, 2.]), -1, 1, 0.5)[0]
+        array([1, 0, 0, 2])
+    """
+    n_bin = int(round((hi - lo)/w))
+    x = np.ravel(x)
+
+    block_size = 1 << 20
+    counts = np.zeros(n_bin, dtype=np.int64)
+    for i in range(0, x.size, block_size):
+        block = x[i:i+block_size]
+        block = block[np.logical_and(block >= lo, block <= hi)]  # also drops nan
+        idx = np.floor((block - lo) / w).astype(np.intp)
+        np.minimum(idx, n_bin - 1, out=idx)  # hi into the last bin
+        counts += np.bincount(idx, minlength=n_bin)
+    bin_edges = lo + np.arange(n_bin + 1)*w
+
+    return counts, bin_edges
+
+
+#%%
+def calc_mode_per_label(labels, values, n_label=256):
+    """
+    Mode of integer values within each label (e.g. SNAPHU connected component),
+    counted in one pass with np.bincount on a combined (label, value) key.
+    labels and values are 1D arrays of the same length, labels in 0..n_label-1.
+    Ties resolve to the smallest value, as scipy.stats.mode.
+    int8 values use the fixed offset of 128 without scanning for their range.
+
+    Returns:
+        mode_per_label : Array of length n_label, 0 for labels without values.
+        has_values     : Bool array of length n_label, False for labels without
+                         values (e.g. components where all residuals are nan),
+                         whose mode is unknown.
+
+    Example (label 2 has no values):
+        >>> calc_mode_per_label(np.array([1, 1, 1, 3]), np.array([2, 2, -1, 0], dtype=np.int8), n_label=4)
+        (array([0, 2, 0, 0]), array([False,  True, False,  True]))
+    """
+    mode_per_label = np.zeros(n_label, dtype=np.intp)
+    has_values = np.zeros(n_label, dtype=bool)
+    if values.size == 0:
+        return mode_per_label, has_values
+
+    if values.dtype == np.int8:
+        offset, n_value = 128, 256
+        values = values.astype(np.intp)
+    else:
+        values = values.astype(np.intp)
+        offset = -values.min()
+        n_value = values.max() + offset + 1
+    labels = labels.astype(np.intp)
+    counts = np.bincount(labels*n_value + values + offset, minlength=n_label*n_value).reshape(n_label, n_value)
+    has_values = counts.sum(axis=1) > 0
+    mode_per_label[has_values] = counts.argmax(axis=1)[has_values] - offset
+
+    return mode_per_label, has_values
+
+
+#%%
+def calc_nanrms(x, ref=None):
+    """
+    RMS of x (or of x - ref if ref is given) ignoring nan, reduced over
+    blocks of 2**20 elements of the flattened arrays: each block is converted
+    to float64, its nan dropped and its squares summed with a dot product,
+    so only block-sized temporaries are made and the sum is accumulated in
+    float64. Returns nan if there are no valid values.
+
+    Example:
+        >>> float(calc_nanrms(np.array([3., np.nan, 1.]), ref=np.array([0, 5, 2], dtype=np.int8)))
+        2.23606797749979
+    """
+    x = np.ravel(x)
+    if ref is not None:
+        ref = np.ravel(ref)
+
+    block_size = 1 << 20
+    sum_sq = 0.0
+    n_valid = 0
+    for i in range(0, x.size, block_size):
+        block = x[i:i+block_size].astype(np.float64)
+        if ref is not None:
+            block -= ref[i:i+block_size]
+        block = block[~np.isnan(block)]
+        sum_sq += np.dot(block, block)
+        n_valid += block.size
+
+    if n_valid == 0:
+        return np.nan
+
+    return np.sqrt(sum_sq / n_valid)
+
+
+#%%
+def clip_to_int8(x):
+    """
+    Clip float x in place to [-127, 127], so it can be cast to int8 without
+    wrapping (e.g. 200 would become -56). Used before storing nearest
+    integers of residuals in int8.
+
+    Returns:
+        n_clipped : Number of values that were out of range
+
+    Example:
+        >>> x = np.array([200., -130., 3.])
+        >>> clip_to_int8(x), x.astype(np.int8)
+        (2, array([ 127, -127,    3], dtype=int8))
+    """
+    n_clipped = int(np.count_nonzero(np.abs(x) > 127))
+    if n_clipped:
+        np.clip(x, -127, 127, out=x)
+
+    return n_clipped
+
+
 #%%
 def comp_size_time(file_remote, file_local):
     """
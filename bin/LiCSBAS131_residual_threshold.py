@@ -30,18 +30,25 @@ Outputs in TS_GEOCml*/ :
 Usage
 =====
 LiCSBAS131_residual_threshold.py [-h] [-f FRAME_DIR] [-g UNW_DIR] [-t TS_DIR]
-                                        [-p PERCENTILE] [--suffix SUFFIX]
+                                        [-p PERCENTILE] [--suffix SUFFIX] [--no_memmap] [-n N_PARA]
 """
 
 
 import numpy as np
+import warnings
+import matplotlib
+with warnings.catch_warnings(): ## To silence user warning
+    warnings.simplefilter('ignore', UserWarning)
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
 import glob
 import argparse
 import sys
 import time
+import multiprocessing as multi
 import LiCSBAS_io_lib as io_lib
+import LiCSBAS_tools_lib as tools_lib
 
 
 class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter):
@@ -64,6 +71,8 @@ def init_args():
     parser.add_argument('-p', dest='percentile', type=float, help="optional percentile RMS for thresholding")
     parser.add_argument('--suffix', default="", type=str, help="suffix of both input and output")
     parser.add_argument('--no_depeak', default=False, action='store_true', help="don't offset by mode (recommend depeak)")
+    parser.add_argument('--no_memmap', default=False, action='store_true', help="read whole residual files instead of memory-mapping them (can be faster on some network filesystems)")
+    parser.add_argument('-n', dest='n_para', type=int, help="number of processes for parallel processing")
     args = parser.parse_args()
 
 
@@ -103,7 +112,7 @@ def set_input_output():
 
 
 def get_para():
-    global width, length, coef_r2m
+    global width, length, coef_r2m, coef_mm2num_2pi, n_para
 
     # read ifg size and satellite frequency
     mlipar = os.path.join(unwdir, 'slc.mli.par')
@@ -113,29 +122,50 @@ def get_para():
     speed_of_light = 299792458  # m/s
     wavelength = speed_of_light/radar_frequency
     coef_r2m = -wavelength/4/np.pi*1000
+    coef_mm2num_2pi = np.float32(1 / (coef_r2m * 2 * np.pi))  # multiply residual in mm to get number of 2pi
+
+    # multi-processing
+    if not args.n_para:
+        try:
+            n_para = min(len(os.sched_getaffinity(0)), 8) # maximum use 8 cores
+        except:
+            n_para = multi.cpu_count()
+    else:
+        n_para = args.n_para
+
+
+def calc_depeaked_res_rms(res_file):
+    """ Return pair and RMS of its de-peaked residual (in number of 2pi)"""
+    pair = os.path.basename(res_file).split('.')[0][-17:]
+    res_mm = io_lib.read_img(res_file, length, width, memmap=not args.no_memmap)
+    res_num_2pi = res_mm * coef_mm2num_2pi
+    if not args.no_depeak:
+        # offset in place by the peak of uniform 0.1 bins between -2.5 and 2.5
+        res_num_2pi -= tools_lib.calc_hist_peak(res_num_2pi)
+    res_rms = tools_lib.calc_nanrms(res_num_2pi)
+    return pair, res_rms
 
 
 def plot_histogram_of_rms_of_depeaked_residuals():
     print('Reading residual maps from {}'.format(resdir))
+    res_list = glob.glob(os.path.join(resdir, '*.res'))
+
+    # calc rms of de-peaked residuals, each ifg independently, in parallel for large sets
+    # imap keeps results in the order of res_list
+    if n_para > 1 and len(res_list) > 20:
+        with multi.Pool(processes=n_para) as pool:
+            results = list(pool.imap(calc_depeaked_res_rms, res_list, chunksize=max(1, len(res_list) // (n_para * 4))))
+    else:
+        results = [calc_depeaked_res_rms(i) for i in res_list]
+
     with open(restxtfile, "w") as f:
         print('# RMS of residual (in number of 2pi)', file=f)
 
-        # calc rms of de-peaked residuals
         res_rms_list = []
-        for i in glob.glob(os.path.join(resdir, '*.res')):
-            pair = os.path.basename(i).split('.')[0][-17:]
+        for pair, res_rms in results:
             print(pair)
-            res_mm = np.fromfile(i, dtype=np.float32)
-            res_rad = res_mm / coef_r2m
-            res_num_2pi = res_rad / 2 / np.pi
-            if not args.no_depeak:
-                counts, bins = np.histogram(res_num_2pi, np.arange(-2.5, 2.6, 0.1))
-                peak = bins[counts.argmax()] + 0.05
-                res_num_2pi = res_num_2pi - peak
-            res_rms = np.sqrt(np.nanmean(res_num_2pi ** 2))
             res_rms_list.append(res_rms)
-
-            print('{} {:5.2f}'.format(pair, res_rms), file=f)
+        f.write(''.join('{} {:5.2f}\n'.format(pair, res_rms) for pair, res_rms in results))
 
         # plotting histogram and peak and threshold vertical lines
         count_ifg_res_rms, bin_edges, patches = plt.hist(res_rms_list, np.arange(0, 3, 0.1))
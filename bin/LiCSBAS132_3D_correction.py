@@ -64,12 +64,14 @@ LiCSBAS132_3D_correction.py [-h] [-f FRAME_DIR] [-c COMP_CC_DIR] [-g UNW_DIR]
                                    [-r CORRECT_DIR] [-t TS_DIR] [--thresh THRESH] [--suffix SUFFIX]
 """
 
-from scipy import stats
 import numpy as np
+import warnings
 import matplotlib
+with warnings.catch_warnings(): ## To silence user warning
+    warnings.simplefilter('ignore', UserWarning)
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
-import copy
 import glob
 import argparse
 import sys
@@ -84,8 +86,12 @@ import LiCSBAS_tools_lib as tools_lib
 import LiCSBAS_plot_lib as plot_lib
 import LiCSBAS_inv_lib as inv_lib
 import shutil
+import traceback
 import multiprocessing as multi
 
+TWO_PI_F32 = np.float32(2 * np.pi)  # keeps 2pi scaling of float32 and int8 arrays in float32
+plot_queue = None  # queue to the plotting processes, set in the decision pool workers only
+
 
 class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter):
     '''
@@ -115,6 +121,7 @@ def init_args():
     parser.add_argument('--no_depeak', default=False, action='store_true', help="don't offset by residual mode before calculation (recommend depeak)")
     parser.add_argument('--correction_by_mode', default=False, action='store_true', help="perform correction by mode only")
     parser.add_argument('--correction_by_integer', default=False, action='store_true', help="perform correction by integer only")
+    parser.add_argument('--no_memmap', default=False, action='store_true', help="read whole input files instead of memory-mapping them (can be faster on some network filesystems)")
     parser.add_argument('--best_network', default=False, action='store_true', help="make a connected network with the best ifgs")
     args = parser.parse_args()
 
@@ -185,7 +192,7 @@ def set_input_output():
 
 
 def get_para():
-    global width, length, coef_r2m, correction_thresh, target_thresh, ref_x, ref_y, n_para, res_list, resid_threshold_file
+    global width, length, coef_r2m, coef_mm2num_2pi, correction_thresh, target_thresh, ref_x, ref_y, n_para, res_list, resid_threshold_file
 
     # read ifg size and satellite frequency
     mlipar = os.path.join(ccdir, 'slc.mli.par')
@@ -195,6 +202,7 @@ def get_para():
     speed_of_light = 299792458  # m/s
     wavelength = speed_of_light/radar_frequency
     coef_r2m = -wavelength/4/np.pi*1000
+    coef_mm2num_2pi = np.float32(1 / (coef_r2m * 2 * np.pi))  # multiply residual in mm to get number of 2pi
 
     # read reference for plotting purpose
     reffile = os.path.join(infodir, '120ref.txt')
@@ -245,22 +253,52 @@ def perform_correction(ifg_list=None):
     if ifg_list:
         res_list = [os.path.join(resdir, x+'.res') for x in ifg_list]
 
-    # parallel processing
-    if n_para > 1 and len(res_list) > 100:
-        pool = multi.Pool(processes=n_para)
-        results = pool.map(correction_decision, even_split(res_list, n_para))
-        # compile results from different parallel processes
-        for bad_list, mode_list, int_list, good_list in results:
-            bad_ifg_not_corrected.extend(bad_list)
-            ifg_corrected_by_mode.extend(mode_list)
-            ifg_corrected_by_integer.extend(int_list)
-            good_ifg.extend(good_list)
+    # decision returned by correction_decision_single and the list it goes to
+    decision_lists = {'good': good_ifg, 'bad': bad_ifg_not_corrected,
+                      'mode': ifg_corrected_by_mode, 'int': ifg_corrected_by_integer}
+
+    # resolve file paths once here rather than in every worker call
+    ifg_path_list = [get_ifg_paths(res_file) for res_file in res_list]
+    n_ifg = len(ifg_path_list)
+
+    # parallel processing, results are streamed back as soon as each ifg is done
+    # and the decision workers queue their pngs straight to separate plotting processes,
+    # so plot arrays are passed once and plotting doesn't hold up the corrections
+    if n_para > 1 and n_ifg > 100:
+        chunksize = max(1, n_ifg // (n_para * 4))
+        queue = multi.Queue(maxsize=2 * n_para)  # limit the number of arrays queued in memory for plotting
+        plotters = [multi.Process(target=plot_worker, args=(queue,), daemon=True) for i in range(n_para)]
+        for plotter in plotters:
+            plotter.start()
+        with multi.Pool(processes=n_para, initializer=init_decision_worker, initargs=(queue,)) as pool:
+            results = pool.imap_unordered(correction_decision_queued, ifg_path_list, chunksize=chunksize)
+            for i_ifg, (decision, pair, messages) in enumerate(results):
+                print_decision(i_ifg, n_ifg, pair, messages)
+                decision_lists[decision].append(pair)
+            # let the workers exit normally so their queued plot tasks are flushed
+            pool.close()
+            pool.join()
+        for plotter in plotters:
+            queue.put(None)
+        for plotter in plotters:
+            plotter.join()
+        if any(plotter.exitcode != 0 for plotter in plotters):
+            raise Exception("Plotting failed for some ifgs, see the errors above")
     else:
-        bad_list, mode_list, int_list, good_list = correction_decision(res_list)
-        bad_ifg_not_corrected.extend(bad_list)
-        ifg_corrected_by_mode.extend(mode_list)
-        ifg_corrected_by_integer.extend(int_list)
-        good_ifg.extend(good_list)
+        init_scratch()
+        for i_ifg, ifg_paths in enumerate(ifg_path_list):
+            decision, pair, plot_task, messages = correction_decision_single(ifg_paths)
+            print_decision(i_ifg, n_ifg, pair, messages)
+            decision_lists[decision].append(pair)
+            if plot_task:
+                plot_func, plot_args = plot_task
+                plot_func(*plot_args)
+
+
+def print_decision(i_ifg, n_ifg, pair, messages):
+    print("{} ({}/{})".format(pair, i_ifg + 1, n_ifg))
+    for message in messages:
+        print(message)
 
 
 def even_split(a, n):
@@ -270,131 +308,217 @@ def even_split(a, n):
     return [a[i*k+min(i, m):(i+1)*k+min(i+1, m)] for i in range(n)]
 
 
-def load_res(res_file, length, width):
-    res_mm = np.fromfile(res_file, dtype=np.float32).reshape((length, width))
-    res_rad = res_mm / coef_r2m
-    res_num_2pi = res_rad / 2 / np.pi
-    if not args.no_depeak:
-        counts, bins = np.histogram(res_num_2pi, np.arange(-2.5, 2.6, 0.1))
-        peak = bins[counts.argmax()] + 0.05
-        res_num_2pi = res_num_2pi - peak
-    res_rms = np.sqrt(np.nanmean(res_num_2pi ** 2))
-    del res_mm, res_rad
-    return res_num_2pi, res_rms
+def init_scratch():
+    """ Allocate image-sized arrays reused by correction_decision_single for every ifg in this process"""
+    global scratch_res, scratch_int, scratch_mode
+    scratch_res = np.empty((length, width), dtype=np.float32)
+    scratch_int = np.empty((length, width), dtype=np.int8)
+    scratch_mode = np.empty((length, width), dtype=np.int8)
 
 
-def correction_decision(res_list):
-    # # set up
-    bad_list = []
-    mode_list = []
-    int_list = []
-    good_list = []
+def init_decision_worker(queue):
+    """ Pool initializer of the decision workers: allocate scratch arrays and keep the queue to the plotting processes"""
+    global plot_queue
+    plot_queue = queue
+    init_scratch()
 
-    for i in res_list:
-        # read input res
-        pair = os.path.basename(i).split('.')[0][-17:]
-        print(pair)
-        res_num_2pi, res_rms = load_res(i, length, width)
 
-        if res_rms < correction_thresh: # good
-            good_list.append(pair)
-            print("RMS residual = {:.2f}, good...".format(res_rms))
+def correction_decision_queued(ifg_paths):
+    """ correction_decision_single for the decision pool, putting the plot task on the plotting queue from the worker"""
+    decision, pair, plot_task, messages = correction_decision_single(ifg_paths)
+    if plot_task:
+        plot_queue.put(plot_task)
+    return decision, pair, messages
+
+
+def plot_worker(queue):
+    """ Render (plot_func, plot_args) tasks from queue until None. A failed plot is reported and the
+    queue keeps being drained so the decision workers never block, the exit status flags the failure"""
+    n_failed = 0
+    for plot_func, plot_args in iter(queue.get, None):
+        try:
+            plot_func(*plot_args)
+        except Exception:
+            traceback.print_exc()
+            n_failed += 1
+    if n_failed:
+        sys.exit(1)
+
+
+def load_res(res_file, length, width, out=None):
+    # convert mm to number of 2pi, the only copy of the (memory-mapped) residual
+    res_mm = io_lib.read_img(res_file, length, width, memmap=not args.no_memmap)
+    res_num_2pi = np.multiply(res_mm, coef_mm2num_2pi, out=out)
+    del res_mm
+    if not args.no_depeak:
+        # offset in place by the peak of uniform 0.1 bins between -2.5 and 2.5
+        res_num_2pi -= tools_lib.calc_hist_peak(res_num_2pi)
+    res_rms = tools_lib.calc_nanrms(res_num_2pi)
+    return res_num_2pi, res_rms
+
+
+def calc_res_integer(res_num_2pi, valid, out=None):
+    """ Return the nearest integers of the residual as int8, 0 where residual is nan,
+    the RMS residual after subtracting them, and the number of nearest integers clipped to +/-127 to fit in int8"""
+    res_valid = res_num_2pi[valid]
+    res_integer_valid = np.rint(res_valid)
+    rms_res_integer_corrected = tools_lib.calc_nanrms(res_valid, ref=res_integer_valid)
+
+    # nearest integers fit in int8, a quarter of the bytes of float32, once clipped so that beyond +/-127 cycles don't wrap
+    n_clipped = tools_lib.clip_to_int8(res_integer_valid)
+    res_integer = np.empty(res_num_2pi.shape, dtype=np.int8) if out is None else out
+    res_integer.fill(0)
+    res_integer[valid] = res_integer_valid
+    return res_integer, rms_res_integer_corrected, n_clipped
+
+
+def clipped_message(n_clipped):
+    """ Log message for the nearest integers clipped by calc_res_integer"""
+    return "{} pixels with residuals beyond +/-127 cycles, nearest integers clipped to +/-127...".format(n_clipped)
+
+
+def mask_invalid(array, valid, dtype=np.float32):
+    """ Return a float copy of array with nan where the residual is not valid, e.g. int8 integers for plotting"""
+    array = array.astype(dtype)
+    array[~valid] = np.nan
+    return array
+
+
+def plot_payload(array):
+    """ Residual or integer array (in number of 2pi) to put in a plot task. Queued to the plotting processes, it is sent as
+    a float16 copy, enough for the fixed -2..2 colour scale, half the bytes to pickle and not overwritten when the scratch
+    arrays are reused for the next ifg. Plotted inline in this process before the next ifg, the array itself is used.
+    Not for unw in radians, which can exceed the precision and range of float16"""
+    return array if plot_queue is None else array.astype(np.float16)
+
+
+def write_corrected_unw(correct_pair_dir, pair, unw, res_cycles, known):
+    """ Write unw - res_cycles * 2pi, nan where not known, as the corrected unw of pair and return it as a memmap.
+    It is computed straight into a memory-mapped temporary file that is moved into place once complete,
+    or removed on any error, so neither a partial .unw nor a stale .unw.tmp is left behind"""
+    Path(correct_pair_dir).mkdir(parents=True, exist_ok=True)
+    unw_corrected_file = os.path.join(correct_pair_dir, pair + '.unw')
+    unw_corrected = np.memmap(unw_corrected_file + '.tmp', dtype=np.float32, mode='w+', shape=(length, width))
+    try:
+        # scale int8 in float32 into the output file
+        np.multiply(res_cycles, TWO_PI_F32, out=unw_corrected, dtype=np.float32)
+        np.subtract(unw, unw_corrected, out=unw_corrected)
+        unw_corrected[~known] = np.nan
+        unw_corrected.flush()
+        os.replace(unw_corrected_file + '.tmp', unw_corrected_file)
+    except BaseException:
+        del unw_corrected
+        if os.path.exists(unw_corrected_file + '.tmp'):
+            os.remove(unw_corrected_file + '.tmp')
+        raise
+    return unw_corrected
+
+
+def get_ifg_paths(res_file):
+    """ Return pair name and the paths of its res, unw, conncomp and correction output directory"""
+    pair = Path(res_file).stem[-17:]
+    unwfile = os.path.join(unwdir, pair, pair + '.unw')
+    con_file = os.path.join(ccdir, pair, pair + '.conncomp')
+    correct_pair_dir = os.path.join(correct_dir, pair)
+    return pair, res_file, unwfile, con_file, correct_pair_dir
+
+
+def correction_decision_single(ifg_paths):
+    """ Decide whether / how to correct one ifg, given its paths from get_ifg_paths.
+    Return the decision ('good', 'bad', 'mode' or 'int'), the pair, a (plot_func, plot_args) task or None,
+    and the log messages, which are printed by the main process to keep ifgs from interleaving"""
+    pair, res_file, unwfile, con_file, correct_pair_dir = ifg_paths
+    messages = []
+    # dtype of the nan-masked integer copies made for plotting, float16 only if they are queued
+    plot_dtype = np.float32 if plot_queue is None else np.float16
+
+    # read input res
+    res_num_2pi, res_rms = load_res(res_file, length, width, out=scratch_res)
+
+    if res_rms < correction_thresh: # good
+        messages.append("RMS residual = {:.2f}, good...".format(res_rms))
+
+        # Link unw
+        Path(correct_pair_dir).mkdir(parents=True, exist_ok=True)
+        os.link(unwfile, os.path.join(correct_pair_dir, pair + '.unw'))
+
+        # plot good res from a stride-2 preview, a quarter of the pixels to pass around and draw
+        return 'good', pair, (plot_good_res, (pair, plot_payload(res_num_2pi[::2, ::2]), res_rms)), messages
+
+    messages.append("RMS residual = {:2f}, not good...".format(res_rms))
+    # valid residual pixels, shared by the RMS of each correction below
+    valid = ~np.isnan(res_num_2pi)
+    res_integer, rms_res_integer_corrected, n_clipped = calc_res_integer(res_num_2pi, valid, out=scratch_int)
+    if n_clipped:
+        messages.append(clipped_message(n_clipped))
+    if rms_res_integer_corrected > target_thresh: # bad
+        messages.append("Integer reduces rms residuals to {:.2f}, still above threshold of {:.2f}, discard...".format(
+            rms_res_integer_corrected, target_thresh))
+        return 'bad', pair, (plot_bad_res, (pair, plot_payload(res_num_2pi), mask_invalid(res_integer, valid, plot_dtype), res_rms)), messages
+
+    # read in unwrapped ifg
+    unw = io_lib.read_img(unwfile, length, width, memmap=not args.no_memmap)
+
+    # read in connected components
+    con = io_lib.read_img(con_file, length, width, np.int8, memmap=not args.no_memmap)
+    res_mode, rms_res_mode_corrected, mode_known = calc_component_mode(con, res_integer, res_num_2pi, out=scratch_mode, valid=valid)
+
+    # if component mode is useful
+    if rms_res_mode_corrected < target_thresh: # correct by component
+        messages.append(
+            "Component modes reduces rms residuals to {:.2f}, below target threshold of {:.2f}, correcting by component mode...".format(
+                rms_res_mode_corrected, target_thresh))
+        # write the corrected unw, nan where neither residual nor component mode is known
+        unw_corrected = write_corrected_unw(correct_pair_dir, pair, unw, res_mode, mode_known)
+
+        # plotting, unw panels in radians stay float32 as plain arrays of the memmaps
+        decision = 'mode'
+        png_path = os.path.join(mode_png_dir, '{}.png'.format(pair))
+        plot_task = (plot_correction_by_mode, (pair, np.asarray(unw), con, np.asarray(unw_corrected), plot_payload(res_num_2pi),
+                                               mask_invalid(res_integer, valid, plot_dtype), mask_invalid(res_mode, mode_known, plot_dtype), res_rms,
+                                               rms_res_integer_corrected, rms_res_mode_corrected, png_path))
 
-            # define output dir
-            correct_pair_dir = os.path.join(correct_dir, pair)
-            Path(correct_pair_dir).mkdir(parents=True, exist_ok=True)
+    else:  # if component mode is not useful, correct by integer for pixel of high confidence, mask pixel of low confidence
+        messages.append("Component modes reduces rms residuals to {:.2f}, above threshold of {:.2f}...".format(
+            rms_res_mode_corrected, target_thresh))
+        messages.append("Integer reduces rms residuals to {:.2f}, correcting by nearest integer...".format(
+            rms_res_integer_corrected))
 
-            # Link unw
-            unwfile = os.path.join(unwdir, pair, pair + '.unw')
-            linkfile = os.path.join(correct_pair_dir, pair + '.unw')
-            os.link(unwfile, linkfile)
+        # write the corrected unw, nan where residual is not valid
+        unw_corrected = write_corrected_unw(correct_pair_dir, pair, unw, res_integer, valid)
 
-            # plot good res
-            plot_good_res(pair, res_num_2pi, res_rms)
+        # turn uncertain correction into masking
+        mask1 = np.logical_and(abs(res_num_2pi) > 0.2, abs(res_num_2pi) < 0.8)
+        mask2 = np.logical_and(abs(res_num_2pi) > 1.2, abs(res_num_2pi) < 1.8)
+        mask = np.logical_or(mask1, mask2)
+        res_mask = mask_invalid(res_integer, valid)
+        res_mask[mask] = np.nan
+        unw_masked = unw - res_mask * TWO_PI_F32
+        rms_res_mask_corrected = tools_lib.calc_nanrms(res_num_2pi, ref=res_mask)
 
-            del res_num_2pi, res_rms
+        # plotting, unw panels in radians stay float32 as plain arrays of the memmaps
+        decision = 'int'
+        png_path = os.path.join(integer_png_dir, '{}.png'.format(pair))
+        plot_task = (plot_correction_by_integer, (pair, np.asarray(unw), np.asarray(unw_corrected), unw_masked, plot_payload(res_mask),
+                                                  plot_payload(res_num_2pi), mask_invalid(res_integer, valid, plot_dtype), res_rms, rms_res_integer_corrected, rms_res_mask_corrected, png_path))
 
-        else:
-            print("RMS residual = {:2f}, not good...".format(res_rms))
-            res_integer = np.round(res_num_2pi)
-            rms_res_integer_corrected = np.sqrt(np.nanmean((res_num_2pi - res_integer) ** 2))
-            if rms_res_integer_corrected > target_thresh: # bad
-                bad_list.append(pair)
-                print("Integer reduces rms residuals to {:.2f}, still above threshold of {:.2f}, discard...".format(
-                    rms_res_integer_corrected, target_thresh))
-                # plot bad res
-                plot_bad_res(pair, res_num_2pi, res_integer, res_rms)
-
-                del res_num_2pi, res_rms, res_integer, rms_res_integer_corrected
-
-            else:
-                # read in unwrapped ifg and connected components
-                unwfile = os.path.join(unwdir, pair, pair + '.unw')
-                con_file = os.path.join(ccdir, pair, pair + '.conncomp')
-                unw = np.fromfile(unwfile, dtype=np.float32).reshape((length, width))
-                con = np.fromfile(con_file, dtype=np.int8).reshape((length, width))
-                res_mode, rms_res_mode_corrected = calc_component_mode(con, res_integer, res_num_2pi)
-
-                # if component mode is useful
-                if rms_res_mode_corrected < target_thresh: # correct by component
-                    print(
-                        "Component modes reduces rms residuals to {:.2f}, below target threshold of {:.2f}, correcting by component mode...".format(
-                            rms_res_mode_corrected, target_thresh))
-                    unw_corrected = unw - res_mode * 2 * np.pi
-
-                    # plotting
-                    mode_list.append(pair)
-                    png_path = os.path.join(mode_png_dir, '{}.png'.format(pair))
-                    plot_correction_by_mode(pair, unw, con, unw_corrected, res_num_2pi, res_integer, res_mode, res_rms,
-                                            rms_res_integer_corrected, rms_res_mode_corrected, png_path)
-
-                else:  # if component mode is not useful, correct by integer for pixel of high confidence, mask pixel of low confidence
-                    print("Component modes reduces rms residuals to {:.2f}, above threshold of {:.2f}...".format(
-                        rms_res_mode_corrected, target_thresh))
-                    print("Integer reduces rms residuals to {:.2f}, correcting by nearest integer...".format(
-                        rms_res_integer_corrected))
-
-                    unw_corrected = unw - res_integer * 2 * np.pi
-
-                    # turn uncertain correction into masking
-                    mask1 = np.logical_and(abs(res_num_2pi) > 0.2, abs(res_num_2pi) < 0.8)
-                    mask2 = np.logical_and(abs(res_num_2pi) > 1.2, abs(res_num_2pi) < 1.8)
-                    mask = np.logical_or(mask1, mask2)
-                    res_mask = copy.copy(res_integer)
-                    res_mask[mask] = np.nan
-                    unw_masked = unw - res_mask * 2 * np.pi
-                    rms_res_mask_corrected = np.sqrt(np.nanmean((res_num_2pi - res_mask) ** 2))
-
-                    # plotting
-                    int_list.append(pair)
-                    png_path = os.path.join(integer_png_dir, '{}.png'.format(pair))
-                    plot_correction_by_integer(pair, unw, unw_corrected, unw_masked, res_mask, res_num_2pi, res_integer, res_rms, rms_res_integer_corrected, rms_res_mask_corrected, png_path)
-
-                    del mask1, mask2, mask, res_mask, unw_masked, rms_res_mask_corrected
-
-                # define output dir
-                correct_pair_dir = os.path.join(correct_dir, pair)
-                Path(correct_pair_dir).mkdir(parents=True, exist_ok=True)
-
-                # save the corrected unw
-                unw_corrected.flatten().tofile(os.path.join(correct_pair_dir, pair + '.unw'))
-                del con, unw, unw_corrected, res_num_2pi, res_integer, res_rms
-
-    return bad_list, mode_list, int_list, good_list
+    return decision, pair, plot_task, messages
 
 
 def plot_good_res(pair, res_num_2pi, res_rms):
-    ## plot_res
-    plt.imshow(res_num_2pi, vmin=-2, vmax=2, cmap=cm.RdBu, interpolation='nearest')
+    ## plot_res, reusing one cleared figure per process instead of building a new one for every ifg
+    plt.figure(num='good_res', clear=True)
+    # res_num_2pi may be downsampled, keep axes in full resolution pixel coordinates
+    plt.imshow(res_num_2pi, vmin=-2, vmax=2, cmap=cm.RdBu, interpolation='nearest', extent=(-0.5, width-0.5, length-0.5, -0.5))
     plt.title(pair + " RMS_res={:.2f}".format(res_rms))
     plt.colorbar()
     plt.tight_layout()
-    plt.savefig(good_png_dir + '{}.png'.format(pair), dpi=300, bbox_inches='tight')
-    plt.close()
+    plt.savefig(good_png_dir + '{}.png'.format(pair), dpi=150, bbox_inches='tight')
 
 
 def plot_bad_res(pair, res_num_2pi, res_integer, res_rms):
-    fig, ax = plt.subplots(1, 2, figsize=(9, 6))
+    fig = plt.figure(num='bad_res', figsize=(9, 6), clear=True)
+    ax = fig.subplots(1, 2)
     fig.suptitle(pair)
     for x in ax:
         x.axes.xaxis.set_ticklabels([])
@@ -404,13 +528,13 @@ def plot_bad_res(pair, res_num_2pi, res_integer, res_rms):
     ax[0].scatter(ref_x, ref_y, c='r', s=10)
     ax[0].set_title("Residual/2pi (RMS={:.2f})".format(res_rms))
     ax[1].set_title("Nearest integer")
-    plt.colorbar(im_res, ax=ax, location='right', shrink=0.8)
-    plt.savefig(bad_png_dir + '{}.png'.format(pair), dpi=300, bbox_inches='tight')
-    plt.close()
+    fig.colorbar(im_res, ax=ax, location='right', shrink=0.8)
+    fig.savefig(bad_png_dir + '{}.png'.format(pair), dpi=150, bbox_inches='tight')
 
 
 def plot_correction_by_mode(pair, unw, con, unw_corrected, res_num_2pi, res_integer, res_mode, res_rms, rms_res_integer_corrected, rms_res_mode_corrected, png_path):
-    fig, ax = plt.subplots(2, 3, figsize=(9, 5))
+    fig = plt.figure(num='correction_by_mode', figsize=(9, 5), clear=True)
+    ax = fig.subplots(2, 3)
     fig.suptitle(pair)
     for x in ax[:, :].flatten():
         x.axes.xaxis.set_ticklabels([])
@@ -432,12 +556,12 @@ def plot_correction_by_mode(pair, unw, con, unw_corrected, res_num_2pi, res_inte
     ax[1, 2].set_title("Component mode (to {:.2f})".format(rms_res_mode_corrected))
     fig.colorbar(im_unw, ax=ax[0, :], location='right', shrink=0.8)
     fig.colorbar(im_res, ax=ax[1, :], location='right', shrink=0.8)
-    plt.savefig(png_path, dpi=300, bbox_inches='tight')
-    plt.close()
+    fig.savefig(png_path, dpi=150, bbox_inches='tight')
 
 
 def plot_correction_by_integer(pair, unw, unw_corrected, unw_masked, res_mask, res_num_2pi, res_integer, res_rms, rms_res_integer_corrected, rms_res_mask_corrected, png_path):
-    fig, ax = plt.subplots(2, 3, figsize=(9, 5))
+    fig = plt.figure(num='correction_by_integer', figsize=(9, 5), clear=True)
+    ax = fig.subplots(2, 3)
     fig.suptitle(pair)
     for x in ax[:, :].flatten():
         x.axes.xaxis.set_ticklabels([])
@@ -459,36 +583,32 @@ def plot_correction_by_integer(pair, unw, unw_corrected, unw_masked, res_mask, r
     ax[1, 2].set_title("Masked Integer ({:.2f})".format(rms_res_mask_corrected))
     fig.colorbar(im_unw, ax=ax[0, :], location='right', shrink=0.8)
     fig.colorbar(im_res, ax=ax[1, :], location='right', shrink=0.8)
-    plt.savefig(png_path, dpi=300, bbox_inches='tight')
-    plt.close()
+    fig.savefig(png_path, dpi=150, bbox_inches='tight')
 
 
 def save_lists():
 
     #%% save ifg lists to text files.
     bad_ifg_file = os.path.join(infodir, '132bad_ifg{}_{:.2f}_{:.2f}.txt'.format(args.suffix, correction_thresh, target_thresh))
-    if os.path.exists(bad_ifg_file): os.remove(bad_ifg_file)
-    with open(bad_ifg_file, 'w') as f:
-        for i in bad_ifg_not_corrected:
-            print('{}'.format(i), file=f)
+    write_ifg_list(bad_ifg_not_corrected, bad_ifg_file)
 
     mode_ifg_file = os.path.join(infodir, '132corrected_by_component_mode_ifg{}_{:.2f}_{:.2f}.txt'.format(args.suffix, correction_thresh, target_thresh))
-    if os.path.exists(mode_ifg_file): os.remove(mode_ifg_file)
-    with open(mode_ifg_file, 'w') as f:
-        for i in ifg_corrected_by_mode:
-            print('{}'.format(i), file=f)
+    write_ifg_list(ifg_corrected_by_mode, mode_ifg_file)
 
     nearest_ifg_file = os.path.join(infodir, '132corrected_by_nearest_integer_ifg{}_{:.2f}_{:.2f}.txt'.format(args.suffix, correction_thresh, target_thresh))
-    if os.path.exists(nearest_ifg_file): os.remove(nearest_ifg_file)
-    with open(nearest_ifg_file, 'w') as f:
-        for i in ifg_corrected_by_integer:
-            print('{}'.format(i), file=f)
+    write_ifg_list(ifg_corrected_by_integer, nearest_ifg_file)
 
     good_ifg_file = os.path.join(infodir, '132good_ifg_uncorrected{}_{:.2f}_{:.2f}.txt'.format(args.suffix, correction_thresh, target_thresh))
-    if os.path.exists(good_ifg_file): os.remove(good_ifg_file)
-    with open(good_ifg_file, 'w') as f:
-        for i in good_ifg:
-            print('{}'.format(i), file=f)
+    write_ifg_list(good_ifg, good_ifg_file)
+
+
+def write_ifg_list(ifg_list, ifg_list_file):
+    """ Write one ifg per line to a temporary file and rename it over ifg_list_file,
+    replacing any previous list in one step instead of remove + create"""
+    tmp_file = ifg_list_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(''.join('{}\n'.format(i) for i in ifg_list))
+    os.replace(tmp_file, ifg_list_file)
 
 
 def plot_networks():
@@ -591,23 +711,21 @@ def masking(res_list):
         pair = os.path.basename(i).split('.')[0][-17:]
         print(pair)
         unwfile = os.path.join(unwdir, pair, pair + '.unw')
-        unw = np.fromfile(unwfile, dtype=np.float32).reshape((length, width))
+        unw = io_lib.read_img(unwfile, length, width, memmap=not args.no_memmap)
 
         # count coherence pixels for expected total n_unw
         ccfile = os.path.join(ccdir, pair, pair + '.cc')
         coh = io_lib.read_img(ccfile, length, width, np.uint8)
-        coh = coh.astype(np.float32)
-        coh[coh==0] = np.nan
-        cc_pixel_count = np.count_nonzero(~np.isnan(coh))
+        cc_pixel_count = np.count_nonzero(coh)  # 0 represents nan
 
         # generate a mask using res, and make a masked_residual map (for plotting only)
         res_num_2pi, res_rms = load_res(i, length, width)
         mask = abs(res_num_2pi) > args.mask_thresh
-        res_num_2pi_masked = copy.copy(res_num_2pi)
+        res_num_2pi_masked = res_num_2pi.copy()
         res_num_2pi_masked[mask] = np.nan
 
         # mask unw and calculate percentage unwrap
-        unw_masked = copy.copy(unw)
+        unw_masked = unw.copy()
         unw_masked[mask] = np.nan
         unw_masked_pixel_count = np.count_nonzero(~np.isnan(unw_masked))
         unw_percentage = unw_masked_pixel_count/cc_pixel_count * 100
@@ -620,7 +738,7 @@ def masking(res_list):
         # output masked unw
         mask_pair_dir = os.path.join(mask_dir, pair)
         Path(mask_pair_dir).mkdir(parents=True, exist_ok=True)
-        unw_masked.flatten().tofile(os.path.join(mask_pair_dir, pair + '.unw'))
+        unw_masked.tofile(os.path.join(mask_pair_dir, pair + '.unw'))
 
         del unw, unw_masked, res_num_2pi, mask, res_num_2pi_masked
     return unw_perc_list
@@ -628,7 +746,8 @@ def masking(res_list):
 
 def plot_masking(pair, unw, unw_masked, res_num_2pi, res_num_2pi_masked, png):
     # plotting
-    fig, ax = plt.subplots(2, 2, figsize=(9, 6))
+    fig = plt.figure(num='masking', figsize=(9, 6), clear=True)
+    ax = fig.subplots(2, 2)
     fig.suptitle(pair)
     for x in ax.flatten():
         x.axes.xaxis.set_ticklabels([])
@@ -652,8 +771,7 @@ def plot_masking(pair, unw, unw_masked, res_num_2pi, res_num_2pi_masked, png):
     fig.colorbar(im_unw, ax=ax[0, :], location='right', shrink=0.8)
     fig.colorbar(im_res, ax=ax[1, :], location='right', shrink=0.8)
 
-    plt.savefig(png, dpi=300, bbox_inches='tight')
-    plt.close()
+    fig.savefig(png, dpi=150, bbox_inches='tight')
 
 
 def plot_network_with_unw_perc(perc_list):
@@ -679,48 +797,58 @@ def mode_correction():
         correcting_by_mode(res_list)
 
 
-def calc_component_mode(con, res_integer, res_num_2pi):
-    # calculate component modes
-    uniq_components = np.unique(con.flatten())[1:]  # use [1:] to exclude the 0th component
-    res_mode = copy.copy(res_integer)
-    for j in uniq_components:
-        component_values = res_integer[con == j]
-        int_values = component_values[~np.isnan(component_values)].astype(int)
-        mode = stats.mode(int_values)[0][0]
-        res_mode[con == j] = mode
-    rms_res_mode_corrected = np.sqrt(np.nanmean((res_num_2pi - res_mode) ** 2))
-    return res_mode, rms_res_mode_corrected
+def calc_component_mode(con, res_integer, res_num_2pi, out=None, valid=None):
+    """ Return the int8 component mode of the nearest integers, its RMS residual after correction,
+    and where it is known: valid residuals, or connected components with at least one valid residual"""
+    # valid residual pixels, can be passed in if already known
+    if valid is None:
+        valid = ~np.isnan(res_num_2pi)
+
+    # calculate component modes in one pass by counting (label, integer) pairs with a combined key
+    labels = con.view(np.uint8)  # SNAPHU labels are non-negative, 0th component is not connected
+    labelled_valid = np.logical_and(valid, labels > 0)
+    mode_per_label, has_mode = tools_lib.calc_mode_per_label(labels[labelled_valid], res_integer[labelled_valid])
+    # components whose residuals are all nan have no mode, like unconnected pixels of nan residual they stay nan
+    has_mode[0] = False
+    mode_known = np.logical_or(valid, np.take(has_mode, labels))
+
+    # broadcast int8 modes back with one lookup, unconnected pixels keep their int8 nearest integer
+    mode_lut = mode_per_label.astype(np.int8)
+    res_mode = np.take(mode_lut, labels, out=out)
+    np.copyto(res_mode, res_integer, where=labels == 0)
+    rms_res_mode_corrected = tools_lib.calc_nanrms(res_num_2pi, ref=res_mode)
+    return res_mode, rms_res_mode_corrected, mode_known
 
 
 def correcting_by_mode(reslist):
+    # plots are drawn before the next ifg, so the same scratch arrays can be refilled for every ifg
+    init_scratch()
     for i in reslist:
         pair = os.path.basename(i).split('.')[0][-17:]
         print(pair)
-        res_num_2pi, res_rms = load_res(i, length, width)
-        res_integer = np.round(res_num_2pi)
-        rms_res_integer_corrected = np.sqrt(np.nanmean((res_num_2pi - res_integer) ** 2))
+        res_num_2pi, res_rms = load_res(i, length, width, out=scratch_res)
+        valid = ~np.isnan(res_num_2pi)
+        res_integer, rms_res_integer_corrected, n_clipped = calc_res_integer(res_num_2pi, valid, out=scratch_int)
+        if n_clipped:
+            print(clipped_message(n_clipped))
 
         # calc component mode
         unwfile = os.path.join(unwdir, pair, pair + '.unw')
         con_file = os.path.join(ccdir, pair, pair + '.conncomp')
-        unw = np.fromfile(unwfile, dtype=np.float32).reshape((length, width))
-        con = np.fromfile(con_file, dtype=np.int8).reshape((length, width))
-        res_mode, rms_res_mode_corrected = calc_component_mode(con, res_integer, res_num_2pi)
+        unw = io_lib.read_img(unwfile, length, width, memmap=not args.no_memmap)
+        con = io_lib.read_img(con_file, length, width, np.int8, memmap=not args.no_memmap)
+        res_mode, rms_res_mode_corrected, mode_known = calc_component_mode(con, res_integer, res_num_2pi, out=scratch_mode, valid=valid)
 
         # correcting by component mode
-        unw_corrected = unw - res_mode * 2 * np.pi
+        correct_pair_dir = os.path.join(correct_dir, pair)
+        # write the corrected unw before plotting, so a plotting error doesn't throw away the correction
+        unw_corrected = write_corrected_unw(correct_pair_dir, pair, unw, res_mode, mode_known)
 
         # plotting
         png_path = os.path.join(mode_png_dir, '{}.png'.format(pair))
-        plot_correction_by_mode(pair, unw, con, unw_corrected, res_num_2pi, res_integer, res_mode,
+        plot_correction_by_mode(pair, unw, con, unw_corrected, res_num_2pi, mask_invalid(res_integer, valid), mask_invalid(res_mode, mode_known),
                         res_rms, rms_res_integer_corrected, rms_res_mode_corrected, png_path)
 
-        # define output dir
-        correct_pair_dir = os.path.join(correct_dir, pair)
-        Path(correct_pair_dir).mkdir(parents=True, exist_ok=True)
-
-        # save the corrected unw
-        unw_corrected.flatten().tofile(os.path.join(correct_pair_dir, pair + '.unw'))
         del con, unw, unw_corrected, res_num_2pi, res_integer, res_rms
 
 
@@ -760,10 +888,7 @@ def best_network(all_ifgs, all_resids):
 
     #%% save ifg lists to text files.
     best_network_ifg_file = os.path.join(infodir, '132best_network_ifg{}_{:.2f}.txt'.format(args.suffix, target_thresh))
-    if os.path.exists(best_network_ifg_file): os.remove(best_network_ifg_file)
-    with open(best_network_ifg_file, 'w') as f:
-        for i in strong_links:
-            print('{}'.format(i), file=f)
+    write_ifg_list(strong_links, best_network_ifg_file)
 
 
 def main():
@@ -10,30 +10,36 @@
 # Written by Qi Ou, University Leeds, 15 Aug 2022
 #################
 
-from scipy import stats
 import numpy as np
+import warnings
 import matplotlib
+with warnings.catch_warnings(): ## To silence user warning
+    warnings.simplefilter('ignore', UserWarning)
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
-import copy
 import glob
 import argparse
 from pathlib import Path
 #import cmcrameri as cm
 from matplotlib import cm
 from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
+import LiCSBAS_io_lib as io_lib
+import LiCSBAS_tools_lib as tools_lib
 
 
 parser = argparse.ArgumentParser(description="Detect coregistration error")
 parser.add_argument('-f', "--frame_dir", default="./", help="directory of LiCSBAS output of a particular frame")
 parser.add_argument('-g', '--GEOCml_dir', dest="unw_dir", default="GEOCml10GACOS", help="folder containing unw input to time series")
 parser.add_argument('-t', '--ts_dir', dest="ts_dir", default="TS_GEOCml10GACOS", help="folder containing unw input to time series")
+parser.add_argument('--no_memmap', default=False, action='store_true', help="read whole input files instead of memory-mapping them (can be faster on some network filesystems)")
 args = parser.parse_args()
 
 speed_of_light = 299792458  # m/s
 radar_frequency = 5405000000.0  # Hz
 wavelength = speed_of_light/radar_frequency
 coef_r2m = -wavelength/4/np.pi*1000
+coef_mm2num_2pi = np.float32(1 / (coef_r2m * 2 * np.pi))  # multiply residual in mm to get number of 2pi
 
 with open('{}/{}/info/13parameters.txt'.format(args.frame_dir, args.ts_dir), 'r') as f:
     for line in f.readlines():
@@ -59,30 +65,47 @@ with open(stats_file, 'w') as f:
     for i in glob.glob('{}/{}/13resid/*.res'.format(args.frame_dir, args.ts_dir)) :
         pair = os.path.basename(i).split('.')[0][-17:]
         print(pair)
-        con = np.fromfile(os.path.join(args.frame_dir, args.unw_dir, pair, pair+'.conncomp'), dtype=np.int8).reshape((azimuth_lines, range_samples))
-        unw = np.fromfile(os.path.join(args.frame_dir, args.unw_dir, pair, pair+'.unw'), dtype=np.float32).reshape((azimuth_lines, range_samples))
+        con = io_lib.read_img(os.path.join(args.frame_dir, args.unw_dir, pair, pair+'.conncomp'), azimuth_lines, range_samples, np.int8, memmap=not args.no_memmap)
+        unw = io_lib.read_img(os.path.join(args.frame_dir, args.unw_dir, pair, pair+'.unw'), azimuth_lines, range_samples, memmap=not args.no_memmap)
 
-        res_mm = np.fromfile(i, dtype=np.float32).reshape((azimuth_lines, range_samples))
-        res_rad = res_mm / coef_r2m
-        res_num_2pi = res_rad / 2 / np.pi
+        res_mm = io_lib.read_img(i, azimuth_lines, range_samples, memmap=not args.no_memmap)
+        res_num_2pi = res_mm * coef_mm2num_2pi
         res_integer = np.round(res_num_2pi)
-        res_rms = np.sqrt(np.nanmean(res_num_2pi**2))
+        res_rms = tools_lib.calc_nanrms(res_num_2pi)
 
-        res_mode = copy.copy(res_integer)
-        for j in np.unique(con.flatten())[1:]:
-            component_values = res_integer[con == j]
-            int_values = component_values[~np.isnan(component_values)].astype(int)
-            mode = stats.mode(int_values)[0][0]
-            res_mode[con == j] = mode
+        # mode of nearest integer in every component in one pass; 0th component is not connected and keeps nearest integer
+        labels = con.view(np.uint8)
+        labelled_valid = np.logical_and(~np.isnan(res_integer), labels > 0)
+        mode_per_label, has_mode = tools_lib.calc_mode_per_label(labels[labelled_valid], res_integer[labelled_valid])
+        mode_lut = mode_per_label.astype(np.float32)
+        mode_lut[~has_mode] = np.nan  # components whose residuals are all nan have no mode
+        res_mode = np.take(mode_lut, labels)
+        np.copyto(res_mode, res_integer, where=labels == 0)
 
         res_mode[np.isnan(res_integer)] = np.nan
 
-        unw_corrected = unw - res_mode * 2 * np.pi
+        # correct straight into a memory-mapped temporary file, moved into place once complete and before plotting,
+        # so a plotting error doesn't throw away the correction, or removed on any error
+        Path("{}/{}_corrected/{}/".format(args.frame_dir, args.unw_dir, pair)).mkdir(parents=True, exist_ok=True)
+        unw_corrected_file = "{}/{}_corrected/{}/{}.unw".format(args.frame_dir, args.unw_dir, pair, pair)
+        unw_corrected = np.memmap(unw_corrected_file + '.tmp', dtype=np.float32, mode='w+', shape=(azimuth_lines, range_samples))
+        try:
+            np.multiply(res_mode, 2 * np.pi, out=unw_corrected)
+            np.subtract(unw, unw_corrected, out=unw_corrected)
+            unw_corrected.flush()
+            os.replace(unw_corrected_file + '.tmp', unw_corrected_file)
+        except BaseException:
+            del unw_corrected
+            if os.path.exists(unw_corrected_file + '.tmp'):
+                os.remove(unw_corrected_file + '.tmp')
+            raise
         #unw_corrected_by_int = unw - res_integer * 2 * np.pi
-        unw_masked = copy.copy(unw)
+        unw_masked = np.array(unw)  # writable in-memory copy of the (memory-mapped) unw
         unw_masked[res_integer != 0] = np.nan
 
-        fig, ax = plt.subplots(3, 3, figsize=(9, 6))
+        # reuse one cleared figure for every ifg
+        fig = plt.figure(num='unw_mask_mode', figsize=(9, 6), clear=True)
+        ax = fig.subplots(3, 3)
         fig.suptitle(pair)
         for x in ax[:2, :].flatten():
             x.axes.xaxis.set_ticklabels([])
@@ -115,8 +138,10 @@ with open(stats_file, 'w') as f:
         fig.colorbar(im_res, ax=ax[1,:], location='right', shrink=0.8)
         fig.colorbar(im_con, ax=ax[2,0], location='right', shrink=0.8)
 
-        ax[2,1].hist(res_num_2pi.flatten(), np.arange(-2.5, 3.5, 1))
-        ax[2,1].hist(res_num_2pi.flatten(), np.arange(-2.5, 2.6, 0.1))
+        # count the bins in one pass each, then draw the counts as weights of the bin edges
+        for bin_width in [1, 0.1]:
+            counts, bin_edges = tools_lib.calc_hist_uniform(res_num_2pi, -2.5, 2.5, bin_width)
+            ax[2,1].hist(bin_edges[:-1], bin_edges, weights=counts)
         ax[2,1].set_yscale("log")
         ax[2,1].set_xlabel("Residual (rad) / 2 pi")
         ax[2,1].set_ylabel("Pixel Count")
@@ -131,11 +156,7 @@ with open(stats_file, 'w') as f:
         percentage_pixel_to_correct_by_2cycles = number_pixels_to_correct_by_2cycles / nonnan_pixel_number * 100
         ax[2, 1].set_title("{}% to correct, {}% >1 cycle".format(int(percentage_pixel_to_correct), int(percentage_pixel_to_correct_by_2cycles)))
 
-        plt.savefig('{}/{}/13resid/{}_unw_mask_mode.png'.format(args.frame_dir, args.ts_dir, pair), dpi=300)
-        plt.close()
-
-        Path("{}/{}_corrected/{}/".format(args.frame_dir, args.unw_dir, pair)).mkdir(parents=True, exist_ok=True)
-        unw_corrected.flatten().tofile("{}/{}_corrected/{}/{}.unw".format(args.frame_dir, args.unw_dir, pair, pair))
+        fig.savefig('{}/{}/13resid/{}_unw_mask_mode.png'.format(args.frame_dir, args.ts_dir, pair), dpi=150)
 
         print(pair,res_rms, "{:.2f}".format(percentage_pixel_to_correct), "{:.2f}".format(percentage_pixel_to_correct_by_2cycles) )
         f.write("{} {:.2f} {:.2f} {:.2f} \n".format(pair, res_rms, percentage_pixel_to_correct, percentage_pixel_to_correct_by_2cycles))